@@ -2,13 +2,33 @@ import streamlit as st
 
 from config import BOOK_METADATA
 from utils.security import RateLimiter, sanitize_input, escape_output
-from utils.models import get_model, get_vectorstore, get_reranker
+from utils.models import get_model, get_draft_model, get_vectorstore, get_reranker
 from core.intent import QueryIntent, detect_query_intent
 from core.retriever import retrieve_context
-from core.generator import generate_response
+from core.generator import generate_response, get_book_list_response
 
 st.set_page_config(page_title="DocRAG", page_icon="📚", layout="wide")
 
+SPINNER_LABELS = {
+    QueryIntent.CROSS_BOOK: "Searching all books...",
+    QueryIntent.COMPARISON: "Comparing...",
+    QueryIntent.STRUCTURE: "Looking up structure in {book}...",
+    QueryIntent.SPECIFIC_BOOK: "Searching {book}...",
+    QueryIntent.FOLLOWUP: "Continuing in {book}...",
+    QueryIntent.GENERAL: "Searching...",
+}
+
+
+@st.cache_resource(show_spinner="Loading...")
+def load_resources():
+    model, tokenizer = get_model()
+    return get_vectorstore(), get_reranker(), model, tokenizer, get_draft_model()
+
+
+@st.cache_data(ttl=3600)
+def get_chunk_count(_vectorstore) -> int:
+    return _vectorstore._collection.count()
+
 
 def init_session():
     defaults = {"messages": [], "history": [], "rate_limiter": RateLimiter()}
@@ -32,6 +52,13 @@ def render_sidebar(chunk_count: int):
             st.rerun()
 
 
+def source_caption(s: dict) -> str:
+    # Sources carry a rerank score, or a cosine similarity when the rerank was skipped
+    if "score" in s:
+        return f"{s['source']} ({s['score']:.2f})"
+    return f"{s['source']} (similarity {s['similarity']:.2f})"
+
+
 def render_history():
     for msg in st.session_state.messages:
         with st.chat_message(msg["role"]):
@@ -39,26 +66,21 @@ def render_history():
             if msg.get("sources"):
                 with st.expander(f"Sources ({len(msg['sources'])})"):
                     for s in msg["sources"]:
-                        st.caption(f"{s['source']} ({s['score']:.2f})")
+                        st.caption(source_caption(s))
 
 
-def process_query(query: str, vectorstore, reranker, model, tokenizer):
+def process_query(query: str, vectorstore, reranker, model, tokenizer, draft_model=None):
     intent, book_ctx = detect_query_intent(query, st.session_state.history)
     
     if intent == QueryIntent.LIST_BOOKS:
-        from core.generator import get_book_list_response
         response = get_book_list_response()
         st.markdown(response)
         return response, [], ""
     
-    label = {
-        QueryIntent.CROSS_BOOK: "Searching all books...",
-        QueryIntent.COMPARISON: "Comparing...",
-        QueryIntent.STRUCTURE: f"Looking up structure in {book_ctx}..." if book_ctx else "Looking up structure...",
-        QueryIntent.SPECIFIC_BOOK: f"Searching {book_ctx}...",
-        QueryIntent.FOLLOWUP: f"Continuing in {book_ctx}...",
-        QueryIntent.GENERAL: "Searching...",
-    }.get(intent, "Processing...")
+    if intent == QueryIntent.STRUCTURE and not book_ctx:
+        label = "Looking up structure..."
+    else:
+        label = SPINNER_LABELS.get(intent, "Processing...").format(book=book_ctx)
     
     with st.spinner(label):
         context, sources, stats = retrieve_context(
@@ -67,7 +89,7 @@ def process_query(query: str, vectorstore, reranker, model, tokenizer):
         )
         response = generate_response(
             query, context, sources, model, tokenizer,
-            st.session_state.history, intent, stats
+            st.session_state.history, intent, stats, draft_model
         )
         response = escape_output(response)
     
@@ -76,7 +98,7 @@ def process_query(query: str, vectorstore, reranker, model, tokenizer):
     if sources:
         with st.expander(f"Sources ({len(sources)}) from {stats['books_searched']} book(s)"):
             for s in sources:
-                st.caption(f"{s['source']} ({s['score']:.2f})")
+                st.caption(source_caption(s))
     
     if not book_ctx and sources and intent not in [QueryIntent.CROSS_BOOK, QueryIntent.COMPARISON]:
         books = set(s["metadata"].get("book_title", "") for s in sources if s["metadata"].get("book_title"))
@@ -90,12 +112,9 @@ def main():
     st.title("📚 Document Q&A")
     init_session()
     
-    with st.spinner("Loading..."):
-        vectorstore = get_vectorstore()
-        reranker = get_reranker()
-        model, tokenizer = get_model()
+    vectorstore, reranker, model, tokenizer, draft_model = load_resources()
     
-    render_sidebar(vectorstore._collection.count())
+    render_sidebar(get_chunk_count(vectorstore))
     render_history()
     
     if query := st.chat_input("Ask about your documents..."):
@@ -115,7 +134,7 @@ def main():
         
         with st.chat_message("assistant"):
             response, sources, book_ctx = process_query(
-                query, vectorstore, reranker, model, tokenizer
+                query, vectorstore, reranker, model, tokenizer, draft_model
             )
         
         st.session_state.messages.append({
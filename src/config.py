@@ -7,14 +7,26 @@ load_dotenv(BASE_DIR / ".env")
 
 DATA_DIR = BASE_DIR / "data"
 DB_DIR = BASE_DIR / "db"
+EMBEDDING_CACHE_DIR = BASE_DIR / "cache" / "embeddings"
 
 MODEL_NAME = os.getenv("MODEL_NAME", "Qwen/Qwen2.5-1.5B-Instruct")
+DRAFT_MODEL_NAME = os.getenv("DRAFT_MODEL_NAME", "")  # e.g. Qwen/Qwen2.5-0.5B-Instruct
+QUANTIZATION = os.getenv("QUANTIZATION", "4bit")  # 4bit, 8bit or none
+COMPILE_MODEL = os.getenv("COMPILE_MODEL", "false").lower() == "true"
 EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "sentence-transformers/all-MiniLM-L6-v2")
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "128"))
 CHROMA_COLLECTION = os.getenv("CHROMA_COLLECTION", "documents")
 MAX_INPUT_CHARS = int(os.getenv("MAX_INPUT_CHARS", "1000"))
 CHUNK_SIZE = int(os.getenv("CHUNK_SIZE", "1500"))
 CHUNK_OVERLAP = int(os.getenv("CHUNK_OVERLAP", "150"))
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", str(os.cpu_count() or 1)))
+PDF_BACKEND = os.getenv("PDF_BACKEND", "pypdf").lower()  # pypdf or pymupdf
 TOP_K = int(os.getenv("TOP_K", "5"))
+RERANK_MAX_LENGTH = int(os.getenv("RERANK_MAX_LENGTH", "512"))
+SEARCH_WORKERS = int(os.getenv("SEARCH_WORKERS", "8"))
+MAX_HISTORY_TOKENS = int(os.getenv("MAX_HISTORY_TOKENS", "400"))
+RETRIEVAL_CACHE_SIZE = int(os.getenv("RETRIEVAL_CACHE_SIZE", "128"))
+RETRIEVAL_CACHE_TTL = int(os.getenv("RETRIEVAL_CACHE_TTL", "300"))  # seconds
 DEDUP_THRESHOLD = float(os.getenv("DEDUP_THRESHOLD", "0.95"))
 
 ALLOWED_EXTENSIONS = {".pdf", ".txt", ".epub"}
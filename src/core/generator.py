@@ -1,10 +1,22 @@
 import torch
-from config import SYSTEM_PROMPT, BOOK_METADATA
-from core.intent import QueryIntent
+from functools import lru_cache
+from transformers import DynamicCache
+
+from config import SYSTEM_PROMPT, BOOK_METADATA, MAX_HISTORY_TOKENS
+from core.intent import QueryIntent, extract_book_references
 from core.validator import validate_response, correction_prompt
 
 
-def get_book_list_response() -> str:
+# Generation budget per intent; structure answers are short TOC listings
+MAX_NEW_TOKENS = {
+    QueryIntent.STRUCTURE: 400,
+    QueryIntent.COMPARISON: 600,
+    QueryIntent.CROSS_BOOK: 700,
+}
+DEFAULT_MAX_NEW_TOKENS = 800
+
+
+def _build_book_list() -> str:
     lines = ["Here are the books available in my knowledge base:\n"]
     for i, (_, meta) in enumerate(BOOK_METADATA.items(), 1):
         lines.append(f"{i}. **{meta['title']}** by {meta['author']} ({meta['publisher']})")
@@ -12,6 +24,14 @@ def get_book_list_response() -> str:
     return "\n".join(lines)
 
 
+_BOOK_LIST_RESPONSE = _build_book_list()
+
+
+def get_book_list_response() -> str:
+    return _BOOK_LIST_RESPONSE
+
+
+@lru_cache(maxsize=64)
 def build_system_prompt(intent: QueryIntent, book_context: str) -> str:
     base = SYSTEM_PROMPT
     
@@ -63,26 +83,97 @@ Rules:
 4. For "how to" questions - provide practical steps from the book"""
 
 
-def _generate(messages: list, model, tokenizer) -> str:
+@lru_cache(maxsize=32)
+def _truncate_turn(tokenizer, text: str) -> str:
+    # Cut on token boundaries; cached because each turn is replayed for the next few queries
+    ids = tokenizer(text, add_special_tokens=False)["input_ids"]
+    if len(ids) <= MAX_HISTORY_TOKENS:
+        return text
+    return tokenizer.decode(ids[:MAX_HISTORY_TOKENS], skip_special_tokens=True)
+
+
+@lru_cache(maxsize=32)
+def _off_source_title_ids(tokenizer, source_books: frozenset) -> tuple:
+    # Token sequences for titles of books that were not retrieved, banned during decoding
+    banned = []
+    for meta in BOOK_METADATA.values():
+        if meta["title"] in source_books:
+            continue
+        for variant in (meta["title"], " " + meta["title"]):
+            banned.append(tuple(tokenizer(variant, add_special_tokens=False)["input_ids"]))
+    return tuple(banned)
+
+
+def _reusable_cache(cache: tuple, input_ids) -> DynamicCache | None:
+    # Keep only the KV entries for the token prefix shared with the new prompt
+    past, past_ids = cache
+    if isinstance(past, tuple):
+        past = DynamicCache.from_legacy_cache(past)
+    
+    limit = min(past.get_seq_length(), len(past_ids), input_ids.shape[-1] - 1)
+    mismatch = (past_ids[:limit] != input_ids[0, :limit]).nonzero()
+    prefix = int(mismatch[0]) if len(mismatch) else limit
+    if prefix == 0:
+        return None
+    past.crop(prefix)
+    return past
+
+
+@lru_cache(maxsize=64)
+def _encode_system(tokenizer, system_prompt: str) -> tuple[str, torch.Tensor]:
+    prefix = tokenizer.apply_chat_template([{"role": "system", "content": system_prompt}], tokenize=False)
+    return prefix, tokenizer(prefix, add_special_tokens=False, return_tensors="pt")["input_ids"]
+
+
+def _encode_messages(messages: list, tokenizer) -> torch.Tensor:
+    if messages[0]["role"] != "system":
+        return tokenizer.apply_chat_template(messages, add_generation_prompt=True, return_tensors="pt")
+    
+    # The system prompt is one of a few fixed strings, so splice in its cached ids
+    # and only tokenize the rendered remainder
     text = tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
-    inputs = tokenizer(text, return_tensors="pt").to(model.device)
+    prefix, prefix_ids = _encode_system(tokenizer, messages[0]["content"])
+    if not text.startswith(prefix):
+        return tokenizer.apply_chat_template(messages, add_generation_prompt=True, return_tensors="pt")
     
-    with torch.no_grad():
+    rest = tokenizer(text[len(prefix):], add_special_tokens=False, return_tensors="pt")["input_ids"]
+    return torch.cat([prefix_ids, rest], dim=1)
+
+
+def _generate(messages: list, model, tokenizer, cache: tuple = None, draft_model=None,
+              bad_words_ids: tuple = (), max_new_tokens: int = DEFAULT_MAX_NEW_TOKENS) -> tuple[str, tuple]:
+    input_ids = _encode_messages(messages, tokenizer).to(model.device)
+    inputs = {"input_ids": input_ids, "attention_mask": torch.ones_like(input_ids)}
+    
+    # A static cache is preallocated per call and cannot be cropped for reuse, and assisted
+    # decoding keeps a separate draft-model cache that would fall out of sync with a cropped one
+    reuse = cache and draft_model is None and model.generation_config.cache_implementation != "static"
+    past = _reusable_cache(cache, input_ids) if reuse else None
+    
+    with torch.inference_mode():
         outputs = model.generate(
             **inputs,
-            max_new_tokens=800,
-            temperature=0.2,
-            do_sample=True,
-            top_p=0.9,
+            max_new_tokens=max_new_tokens,
+            do_sample=False,
+            temperature=None,
+            top_p=None,
+            top_k=None,
             repetition_penalty=1.1,
             pad_token_id=tokenizer.eos_token_id,
+            bad_words_ids=[list(ids) for ids in bad_words_ids] or None,
+            past_key_values=past,
+            assistant_model=draft_model,
+            use_cache=True,
+            return_dict_in_generate=True,
         )
     
-    return tokenizer.decode(outputs[0][inputs["input_ids"].shape[1]:], skip_special_tokens=True).strip()
+    sequence = outputs.sequences[0]
+    response = tokenizer.decode(sequence[inputs["input_ids"].shape[1]:], skip_special_tokens=True).strip()
+    return response, (outputs.past_key_values, sequence)
 
 
 def generate_response(query: str, context: str, sources: list, model, tokenizer,
-                      history: list, intent: QueryIntent, stats: dict) -> str:
+                      history: list, intent: QueryIntent, stats: dict, draft_model=None) -> str:
     if intent == QueryIntent.LIST_BOOKS:
         return get_book_list_response()
     
@@ -94,16 +185,27 @@ def generate_response(query: str, context: str, sources: list, model, tokenizer,
     messages = [{"role": "system", "content": system_prompt}]
     for turn in history[-3:]:
         messages.append({"role": "user", "content": turn.get("user", "")})
-        messages.append({"role": "assistant", "content": turn.get("assistant", "")})
+        messages.append({"role": "assistant", "content": _truncate_turn(tokenizer, turn.get("assistant", ""))})
     messages.append({"role": "user", "content": user_prompt})
     
-    response = _generate(messages, model, tokenizer)
+    # Block citing books outside the retrieved sources up front instead of relying on the retry;
+    # titles the user named stay allowed so the model can say it has no context for them
+    allowed_books = frozenset(stats.get("books", [])) | extract_book_references(query)
+    bad_words_ids = _off_source_title_ids(tokenizer, allowed_books) if context else ()
+    
+    max_new_tokens = MAX_NEW_TOKENS.get(intent, DEFAULT_MAX_NEW_TOKENS)
+    
+    response, cache = _generate(messages, model, tokenizer, draft_model=draft_model,
+                                bad_words_ids=bad_words_ids, max_new_tokens=max_new_tokens)
     
     validation = validate_response(response, context, query)
     
     if not validation.is_valid and validation.confidence < 0.4:
         messages.append({"role": "assistant", "content": response})
         messages.append({"role": "user", "content": correction_prompt(validation.issues, context)})
-        response = _generate(messages, model, tokenizer)
+        # The KV tensors stay on the GPU between the two calls; the correction pass
+        # crops them to the shared prefix and only prefills the correction turn
+        response, _ = _generate(messages, model, tokenizer, cache, draft_model,
+                                bad_words_ids, max_new_tokens)
     
     return response
@@ -1,5 +1,7 @@
 import re
 from enum import Enum
+from functools import lru_cache
+from itertools import islice
 
 
 class QueryIntent(Enum):
@@ -52,17 +54,44 @@ FOLLOWUP_INDICATORS = [
     r'\bor\b', r'\?$', r'^why\b', r'^how\b', r'^is\b',
 ]
 
+SHORT_FOLLOWUP_WORDS = 6
+FOLLOWUP_MAX_WORDS = 10
 
+
+def _compile_any(patterns: list) -> re.Pattern:
+    # One alternation per category so each check is a single regex scan
+    return re.compile("|".join(f"(?:{p})" for p in patterns), re.IGNORECASE)
+
+
+# Book patterns stay separate: the first matching entry wins, not the leftmost match
+_BOOK_RE = [(re.compile(p, re.IGNORECASE), title) for p, title in BOOK_PATTERNS.items()]
+_STRUCTURE_RE = _compile_any(STRUCTURE_PATTERNS)
+_CROSS_BOOK_RE = _compile_any(CROSS_BOOK_PATTERNS)
+_LIST_BOOKS_RE = _compile_any(LIST_BOOKS_PATTERNS)
+_COMPARISON_RE = _compile_any(COMPARISON_PATTERNS)
+_FOLLOWUP_RE = _compile_any(FOLLOWUP_INDICATORS)
+
+
+@lru_cache(maxsize=1024)
 def extract_book_reference(query: str) -> str:
-    query_lower = query.lower()
-    for pattern, book_title in BOOK_PATTERNS.items():
-        if re.search(pattern, query_lower):
+    for pattern, book_title in _BOOK_RE:
+        if pattern.search(query):
             return book_title
     return ""
 
 
+@lru_cache(maxsize=1024)
+def extract_book_references(query: str) -> frozenset:
+    # Every book the query names, by pattern or by full title, not just the first match
+    query_lower = query.lower()
+    return frozenset(
+        title for pattern, title in _BOOK_RE
+        if pattern.search(query) or title.lower() in query_lower
+    )
+
+
 def get_active_book_context(history: list) -> str:
-    for entry in reversed(history[-5:]):
+    for entry in islice(reversed(history), 5):
         ctx = entry.get("book_context", "")
         if ctx:
             return ctx
@@ -70,44 +99,41 @@ def get_active_book_context(history: list) -> str:
 
 
 def has_structure_intent(query: str) -> bool:
-    return any(re.search(p, query.lower()) for p in STRUCTURE_PATTERNS)
+    return _STRUCTURE_RE.search(query) is not None
 
 
 def has_cross_book_intent(query: str) -> bool:
-    return any(re.search(p, query.lower()) for p in CROSS_BOOK_PATTERNS)
+    return _CROSS_BOOK_RE.search(query) is not None
 
 
 def has_comparison_intent(query: str) -> bool:
-    return any(re.search(p, query.lower()) for p in COMPARISON_PATTERNS)
+    return _COMPARISON_RE.search(query) is not None
 
 
 def has_list_books_intent(query: str) -> bool:
-    return any(re.search(p, query.lower()) for p in LIST_BOOKS_PATTERNS)
+    return _LIST_BOOKS_RE.search(query) is not None
 
 
 def is_followup(query: str, history: list) -> bool:
     if not history:
         return False
     
-    query_lower = query.lower().strip()
     word_count = len(query.split())
     
-    # Short queries (<=6 words) with active context are likely followups
-    if word_count <= 6:
+    # Short queries with active context are likely followups
+    if word_count <= SHORT_FOLLOWUP_WORDS:
         return True
     
-    # Check for followup indicators
-    if word_count <= 10:
-        if any(re.search(p, query_lower) for p in FOLLOWUP_INDICATORS):
-            return True
+    # Longer queries are standalone; skip the indicator scan
+    if word_count > FOLLOWUP_MAX_WORDS:
+        return False
     
-    return False
+    return _FOLLOWUP_RE.search(query.strip()) is not None
 
 
-def detect_query_intent(query: str, history: list) -> tuple[QueryIntent, str]:
-    query_lower = query.lower()
-    active_book = get_active_book_context(history)
-    
+@lru_cache(maxsize=1024)
+def _classify_query(query: str) -> tuple[QueryIntent | None, str]:
+    # History-independent part of detection; None means the conversation decides
     if has_list_books_intent(query):
         return QueryIntent.LIST_BOOKS, ""
     
@@ -123,6 +149,16 @@ def detect_query_intent(query: str, history: list) -> tuple[QueryIntent, str]:
     if has_comparison_intent(query):
         return QueryIntent.COMPARISON, ""
     
+    return None, ""
+
+
+def detect_query_intent(query: str, history: list) -> tuple[QueryIntent, str]:
+    intent, book = _classify_query(query)
+    if intent:
+        return intent, book
+    
+    active_book = get_active_book_context(history)
+    
     # If we have active book context, short/followup queries stay in that context
     if active_book:
         if has_structure_intent(query):
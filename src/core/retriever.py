@@ -1,10 +1,13 @@
-import re
-import hashlib
+import time
+import heapq
+import atexit
+import threading
 import concurrent.futures
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+from operator import itemgetter
 from flashrank import RerankRequest
 
-from config import TOP_K
+from config import TOP_K, RERANK_MAX_LENGTH, SEARCH_WORKERS, RETRIEVAL_CACHE_SIZE, RETRIEVAL_CACHE_TTL
 from core.intent import QueryIntent
 
 BOOK_LIST = [
@@ -15,39 +18,66 @@ BOOK_LIST = [
     "Machine Learning Basics",
 ]
 
+# The cross-encoder only scores the first RERANK_MAX_LENGTH tokens, so longer text is
+# clipped well past that window rather than tokenized in full (at the default window this
+# is wider than any chunk, so scores match an unclipped rerank)
+RERANK_MAX_CHARS = RERANK_MAX_LENGTH * 8
+
+# Single-pool intents can drop far-off candidates before reranking; structure queries
+# boost TOC hits after scoring and cross-book queries need every book's candidates
+RERANK_PRECUT_INTENTS = (QueryIntent.GENERAL, QueryIntent.SPECIFIC_BOOK, QueryIntent.FOLLOWUP)
+
+# Shared pool for concurrent vectorstore searches, reused across queries
+_SEARCH_POOL = concurrent.futures.ThreadPoolExecutor(
+    max_workers=max(1, SEARCH_WORKERS), thread_name_prefix="search"
+)
+atexit.register(_SEARCH_POOL.shutdown, wait=False)
+
+# Recent retrieval results: key -> (timestamp, (context, sources, stats)), oldest first.
+# Ingestion runs in its own process, so entries only go stale through RETRIEVAL_CACHE_TTL
+_RETRIEVAL_CACHE = OrderedDict()
+_RETRIEVAL_CACHE_LOCK = threading.Lock()
+
 
 def format_source(meta: dict) -> str:
     book = meta.get("book_title", "Unknown")
-    parts = [f"📖 {book}"]
     
     if meta.get("content_type") == "table_of_contents":
-        parts.append("📑 TOC")
+        location = " | 📑 TOC"
     elif "page" in meta:
-        parts.append(f"p.{meta['page']}")
+        location = f" | p.{meta['page']}"
+    else:
+        location = ""
     
     if "section_title" in meta:
-        parts.append(f"§ {meta['section_title']}")
+        location += f" | § {meta['section_title']}"
     elif "chapter_title" in meta:
-        parts.append(f"Ch: {meta['chapter_title']}")
+        location += f" | Ch: {meta['chapter_title']}"
     
     author = meta.get("author", "")
     if author and author != "Unknown":
-        parts.append(f"by {author}")
+        location += f" | by {author}"
     
-    return " | ".join(parts)
+    return f"📖 {book}{location}"
 
 
-def content_hash(text: str, meta: dict) -> str:
-    # Include metadata in hash to catch duplicates with same content but different sources
-    key = f"{text[:300]}|{meta.get('book_title','')}|{meta.get('page','')}|{meta.get('chapter_title','')}"
-    normalized = re.sub(r'\s+', ' ', key.lower().strip())
-    return hashlib.md5(normalized.encode()).hexdigest()
+def content_key(text: str) -> str:
+    # First 200 non-whitespace characters: catches the same passage stored under
+    # different pages or books, and copies that differ only in spacing
+    return "".join(text[:400].lower().split())[:200]
 
 
-def search_book(query: str, vectorstore, book: str, k: int = 5) -> list:
+def search_toc(query: str, vectorstore, k: int, toc_filter: dict) -> list:
     try:
-        results = vectorstore.similarity_search_with_score(
-            query, k=k, filter={"book_title": book}
+        return vectorstore.similarity_search_with_score(query, k=k, filter=toc_filter)
+    except Exception:
+        return []
+
+
+def search_book(embedding: list, vectorstore, book: str, k: int = 5) -> list:
+    try:
+        results = vectorstore.similarity_search_by_vector_with_relevance_scores(
+            embedding, k=k, filter={"book_title": book}
         )
         return [(doc, score) for doc, score in results]
     except Exception:
@@ -55,99 +85,116 @@ def search_book(query: str, vectorstore, book: str, k: int = 5) -> list:
 
 
 def search_books_parallel(query: str, vectorstore, books: list, k_per_book: int = 4) -> list:
+    # Embed once and share the vector across the per-book searches
+    embedding = vectorstore.embeddings.embed_query(query)
     all_results = []
-    with concurrent.futures.ThreadPoolExecutor(max_workers=len(books)) as executor:
-        futures = {
-            executor.submit(search_book, query, vectorstore, book, k_per_book): book
-            for book in books
-        }
-        for future in concurrent.futures.as_completed(futures):
-            try:
-                all_results.extend(future.result())
-            except Exception:
-                continue
+    futures = [
+        _SEARCH_POOL.submit(search_book, embedding, vectorstore, book, k_per_book)
+        for book in books
+    ]
+    for future in concurrent.futures.as_completed(futures):
+        try:
+            all_results.extend(future.result())
+        except Exception:
+            continue
     return all_results
 
 
 def deduplicate(results: list) -> list:
-    seen_hashes = set()
-    seen_content = set()
+    seen = set()
     unique = []
     
     for doc, score in results:
-        # Hash with metadata
-        h = content_hash(doc.page_content, doc.metadata)
-        
-        # Also check content similarity (first 200 chars)
-        content_key = re.sub(r'\s+', '', doc.page_content[:200].lower())
-        
-        if h not in seen_hashes and content_key not in seen_content:
-            seen_hashes.add(h)
-            seen_content.add(content_key)
-            unique.append({
-                "id": len(unique),
-                "text": doc.page_content,
-                "meta": doc.metadata,
-                "similarity_score": score
-            })
+        key = content_key(doc.page_content)
+        if key in seen:
+            continue
+        seen.add(key)
+        unique.append({
+            "id": len(unique),
+            "text": doc.page_content,
+            "meta": doc.metadata,
+            "similarity_score": score
+        })
     return unique
 
 
+VAGUE_PATTERNS = ('that', 'this', 'it', 'those', 'these', 'do that', 'do this', 'kind of thing')
+
+
 def expand_vague_query(query: str, history: list) -> str:
     """Expand vague queries using previous context"""
-    vague_patterns = ['that', 'this', 'it', 'those', 'these', 'do that', 'do this', 'kind of thing']
-    query_lower = query.lower()
+    # Nothing to expand with on a first turn, so skip the pattern scan entirely
+    if not history:
+        return query
+    prev_query = history[-1].get("user", "")
+    if not prev_query:
+        return query
     
-    if any(p in query_lower for p in vague_patterns) and history:
-        last = history[-1] if history else {}
-        prev_query = last.get("user", "")
-        # Extract key terms from previous query
-        if prev_query:
-            return f"{query} {prev_query}"
+    query_lower = query.lower()
+    if any(p in query_lower for p in VAGUE_PATTERNS):
+        return f"{query} {prev_query}"
     return query
 
 
 def retrieve_context(query: str, vectorstore, reranker, intent: QueryIntent,
                      book_filter: str = "", top_k: int = TOP_K, history: list = None) -> tuple[str, list, dict]:
-    results = []
-    is_structure = intent == QueryIntent.STRUCTURE
-    
     # Expand vague queries
     search_query = expand_vague_query(query, history or [])
     
+    if RETRIEVAL_CACHE_SIZE <= 0:
+        return _retrieve(query, search_query, vectorstore, reranker, intent, book_filter, top_k)
+    
+    # History only matters through the expanded query, so it stands in for it in the key
+    key = (query, search_query, intent.name, book_filter, top_k)
+    now = time.monotonic()
+    with _RETRIEVAL_CACHE_LOCK:
+        hit = _RETRIEVAL_CACHE.get(key)
+        if hit and now - hit[0] < RETRIEVAL_CACHE_TTL:
+            _RETRIEVAL_CACHE.move_to_end(key)
+            return hit[1]
+    
+    result = _retrieve(query, search_query, vectorstore, reranker, intent, book_filter, top_k)
+    with _RETRIEVAL_CACHE_LOCK:
+        _RETRIEVAL_CACHE[key] = (now, result)
+        _RETRIEVAL_CACHE.move_to_end(key)
+        while len(_RETRIEVAL_CACHE) > RETRIEVAL_CACHE_SIZE:
+            _RETRIEVAL_CACHE.popitem(last=False)
+    return result
+
+
+def _retrieve(query: str, search_query: str, vectorstore, reranker, intent: QueryIntent,
+              book_filter: str, top_k: int) -> tuple[str, list, dict]:
+    results = []
+    is_structure = intent == QueryIntent.STRUCTURE
+    
     if intent in [QueryIntent.CROSS_BOOK, QueryIntent.COMPARISON]:
         results = search_books_parallel(search_query, vectorstore, BOOK_LIST, k_per_book=3)
     
     elif intent in [QueryIntent.SPECIFIC_BOOK, QueryIntent.FOLLOWUP, QueryIntent.STRUCTURE] and book_filter:
+        toc_future = None
         if is_structure:
             toc_query = f"{search_query} table of contents chapters sections"
             toc_filter = {"$and": [
                 {"content_type": "table_of_contents"},
                 {"book_title": book_filter}
             ]}
-            try:
-                toc_results = vectorstore.similarity_search_with_score(
-                    toc_query, k=top_k * 3, filter=toc_filter
-                )
-                results.extend(toc_results)
-            except Exception:
-                pass
+            # Run the TOC search alongside the regular one
+            toc_future = _SEARCH_POOL.submit(search_toc, toc_query, vectorstore, top_k * 3, toc_filter)
         
         regular = vectorstore.similarity_search_with_score(
             search_query, k=top_k * 3, filter={"book_title": book_filter}
         )
+        if toc_future:
+            results.extend(toc_future.result())
         results.extend(regular)
     
     elif is_structure:
-        try:
-            toc_results = vectorstore.similarity_search_with_score(
-                query + " table of contents", k=top_k * 2,
-                filter={"content_type": "table_of_contents"}
-            )
-            results.extend(toc_results)
-        except Exception:
-            pass
+        toc_future = _SEARCH_POOL.submit(
+            search_toc, query + " table of contents", vectorstore, top_k * 2,
+            {"content_type": "table_of_contents"}
+        )
         regular = vectorstore.similarity_search_with_score(query, k=top_k * 2)
+        results.extend(toc_future.result())
         results.extend(regular)
     
     else:
@@ -160,16 +207,29 @@ def retrieve_context(query: str, vectorstore, reranker, intent: QueryIntent,
     if not passages:
         return "", [], {"books_searched": 0, "books": []}
     
-    reranked = reranker.rerank(RerankRequest(query=query, passages=passages))
+    if len(passages) <= top_k:
+        # Everything is kept anyway; order by vector similarity (ip distance = 1 - cosine),
+        # kept under its own key since it is not on the cross-encoder's scale
+        rank_key = "similarity"
+        reranked = [{**p, "similarity": 1.0 - p["similarity_score"]} for p in passages]
+    else:
+        rank_key = "score"
+        if intent in RERANK_PRECUT_INTENTS and len(passages) > top_k * 2:
+            # Only the closest 2 * top_k candidates go through the cross-encoder
+            # (ip distance: lower is closer)
+            passages = heapq.nsmallest(top_k * 2, passages, key=itemgetter("similarity_score"))
+        clipped = [{"id": p["id"], "text": p["text"][:RERANK_MAX_CHARS]} for p in passages]
+        scores = {r["id"]: r["score"] for r in reranker.rerank(RerankRequest(query=query, passages=clipped))}
+        reranked = [{**p, "score": scores[p["id"]]} for p in passages]
     
     if is_structure:
         for doc in reranked:
             if doc["meta"].get("content_type") == "table_of_contents":
-                doc["score"] = doc["score"] * 2.0
-    
-    sorted_docs = sorted(reranked, key=lambda x: x["score"], reverse=True)
+                doc[rank_key] = doc[rank_key] * 2.0
     
     if intent in [QueryIntent.CROSS_BOOK, QueryIntent.COMPARISON]:
+        # Per-book caps need the full ordering
+        sorted_docs = sorted(reranked, key=itemgetter(rank_key), reverse=True)
         book_counts = defaultdict(int)
         top_docs = []
         for doc in sorted_docs:
@@ -180,7 +240,7 @@ def retrieve_context(query: str, vectorstore, reranker, intent: QueryIntent,
             if len(top_docs) >= top_k:
                 break
     else:
-        top_docs = sorted_docs[:top_k]
+        top_docs = heapq.nlargest(top_k, reranked, key=itemgetter(rank_key))
     
     sources = []
     context_parts = []
@@ -191,7 +251,7 @@ def retrieve_context(query: str, vectorstore, reranker, intent: QueryIntent,
         books_used.add(book)
         sources.append({
             "source": format_source(doc["meta"]),
-            "score": doc["score"],
+            rank_key: doc[rank_key],
             "metadata": doc["meta"]
         })
         context_parts.append(f"[Source {i} - {book}]\n{doc['text']}")
@@ -1,5 +1,4 @@
 import re
-from difflib import SequenceMatcher
 
 
 class ValidationResult:
@@ -9,59 +8,76 @@ class ValidationResult:
         self.issues = issues
 
 
+SKIP_CLAIM_STARTS = ("I don't", "I cannot", "Based on", "I recommend", "You can",
+                     "For learning", "To learn", "The book", "This book")
+# Most sentences fail on the first character, before any prefix comparison
+_SKIP_FIRST_CHARS = frozenset(p[0] for p in SKIP_CLAIM_STARTS)
+
+WORD_PATTERN = re.compile(r'\b\w{4,}\b')
+NUMBER_PATTERN = re.compile(r'\b(\d+)\s*(chapter|section|part)s?\b')
+NAME_PATTERN = re.compile(r'\b([A-Z][a-z]+ [A-Z][a-z]+)\b')
+SENTENCE_SPLIT = re.compile(r'[.!?]\s+')
+
+# Capitalized word pairs that are prose, not names
+_SKIP_NAMES = frozenset({"The Book", "This Chapter", "For Example", "In This", "Chapter One"})
+# Recommendation queries are opinions, not claims to check against the context
+_SKIP_VALIDATION_QUERIES = ('suggest', 'recommend', 'which book', 'what book', 'should i', 'best book')
+
+
 def extract_claims(response: str) -> list[str]:
-    sentences = re.split(r'[.!?]\s+', response)
     claims = []
-    skip_starts = ("I don't", "I cannot", "Based on", "I recommend", "You can", 
-                   "For learning", "To learn", "The book", "This book")
-    for s in sentences:
+    for s in SENTENCE_SPLIT.split(response):
         s = s.strip()
-        if len(s) > 30 and not s.startswith(skip_starts):
+        if len(s) > 30 and not (s[0] in _SKIP_FIRST_CHARS and s.startswith(SKIP_CLAIM_STARTS)):
             claims.append(s)
     return claims
 
 
-def find_evidence(claim: str, context: str, threshold: float = 0.35) -> tuple[bool, float]:
+class ContextIndex:
+    # Context-side tokenization shared by every check on a response; lowercased once
+    def __init__(self, context: str):
+        context_lower = context.lower()
+        self.words = set(WORD_PATTERN.findall(context_lower))
+        self.chunks = [" ".join(chunk.split()) for chunk in context_lower.split("---")]
+        self.numbers = NUMBER_PATTERN.findall(context_lower)
+        self.names = set(NAME_PATTERN.findall(context))
+
+
+def find_evidence(claim: str, index: ContextIndex, threshold: float = 0.35) -> tuple[bool, float]:
     claim_lower = claim.lower()
-    context_lower = context.lower()
-    
-    claim_words = set(re.findall(r'\b\w{4,}\b', claim_lower))
-    context_words = set(re.findall(r'\b\w{4,}\b', context_lower))
+    claim_words = set(WORD_PATTERN.findall(claim_lower))
     
     if not claim_words:
         return True, 1.0
     
-    overlap = len(claim_words & context_words) / len(claim_words)
+    overlap = len(claim_words & index.words) / len(claim_words)
     
     if overlap >= threshold:
         return True, overlap
     
-    for chunk in context.split("---"):
-        ratio = SequenceMatcher(None, claim_lower[:100], chunk.lower()[:500]).ratio()
-        if ratio > 0.3:
-            return True, max(overlap, ratio)
+    # Low word overlap can still be a verbatim quote that the model continued past
+    lead = " ".join(claim_lower[:100].split())
+    if any(lead in chunk for chunk in index.chunks):
+        return True, max(overlap, threshold)
     
     return False, overlap
 
 
-def check_number_accuracy(response: str, context: str) -> list[str]:
+def check_number_accuracy(response: str, index: ContextIndex) -> list[str]:
     issues = []
-    response_numbers = re.findall(r'\b(\d+)\s*(chapter|section|part)s?\b', response.lower())
-    context_numbers = re.findall(r'\b(\d+)\s*(chapter|section|part)s?\b', context.lower())
+    response_numbers = NUMBER_PATTERN.findall(response.lower())
     
-    if response_numbers and not context_numbers:
+    if response_numbers and not index.numbers:
         issues.append(f"Mentioned {response_numbers[0][0]} {response_numbers[0][1]}s without source")
     return issues
 
 
-def check_names_accuracy(response: str, context: str) -> list[str]:
+def check_names_accuracy(response: str, index: ContextIndex) -> list[str]:
     issues = []
-    response_names = set(re.findall(r'\b([A-Z][a-z]+ [A-Z][a-z]+)\b', response))
-    context_names = set(re.findall(r'\b([A-Z][a-z]+ [A-Z][a-z]+)\b', context))
+    response_names = set(NAME_PATTERN.findall(response))
     
-    skip = {"The Book", "This Chapter", "For Example", "In This", "Chapter One"}
     for name in response_names:
-        if name not in context_names and name not in skip:
+        if name not in index.names and name not in _SKIP_NAMES:
             issues.append(f"Name '{name}' not in context")
     return issues
 
@@ -72,8 +88,7 @@ def validate_response(response: str, context: str, query: str) -> ValidationResu
     
     # Skip validation for recommendation/suggestion queries
     query_lower = query.lower()
-    skip_patterns = ['suggest', 'recommend', 'which book', 'what book', 'should i', 'best book']
-    if any(p in query_lower for p in skip_patterns):
+    if any(p in query_lower for p in _SKIP_VALIDATION_QUERIES):
         return ValidationResult(True, 0.8, [])
     
     issues = []
@@ -85,17 +100,19 @@ def validate_response(response: str, context: str, query: str) -> ValidationResu
     
     supported = 0
     total_conf = 0.0
+    # Tokenize the context once and run every check against the same index
+    index = ContextIndex(context)
     
     for claim in claims:
-        found, conf = find_evidence(claim, context)
+        found, conf = find_evidence(claim, index)
         if found:
             supported += 1
         else:
             issues.append(f"Unsupported: {claim[:50]}...")
         total_conf += conf
     
-    issues.extend(check_number_accuracy(response, context))
-    issues.extend(check_names_accuracy(response, context))
+    issues.extend(check_number_accuracy(response, index))
+    issues.extend(check_names_accuracy(response, index))
     
     ratio = supported / len(claims)
     avg_conf = total_conf / len(claims)
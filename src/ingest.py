@@ -1,77 +1,114 @@
 from pathlib import Path
 from pypdf import PdfReader
 from ebooklib import epub
-from bs4 import BeautifulSoup, XMLParsedAsHTMLWarning
+from lxml import html
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain_huggingface import HuggingFaceEmbeddings
-from langchain_chroma import Chroma
+from langchain_classic.embeddings import CacheBackedEmbeddings
+from langchain_classic.storage import LocalFileStore
+import chromadb
 from tqdm import tqdm
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
+from collections import Counter
+import torch
 import shutil
 import re
 import hashlib
-import warnings
+import io
 import json
 
-warnings.filterwarnings("ignore", category=XMLParsedAsHTMLWarning)
+try:
+    import pymupdf
+except ImportError:
+    pymupdf = None
 
 from config import (
-    DATA_DIR, DB_DIR, ALLOWED_EXTENSIONS, EMBEDDING_MODEL, 
-    CHROMA_COLLECTION, CHUNK_SIZE, CHUNK_OVERLAP, BOOK_METADATA, DEDUP_THRESHOLD
+    DATA_DIR, DB_DIR, EMBEDDING_CACHE_DIR, ALLOWED_EXTENSIONS, EMBEDDING_MODEL, EMBED_BATCH_SIZE,
+    CHROMA_COLLECTION, CHUNK_SIZE, CHUNK_OVERLAP, BOOK_METADATA, DEDUP_THRESHOLD, INGEST_WORKERS, PDF_BACKEND
 )
 
 
-def get_text_hash(text: str) -> str:
-    normalized = re.sub(r'\s+', ' ', text.strip().lower())
-    return hashlib.md5(normalized.encode()).hexdigest()
+_WS_RE = re.compile(r'\s+')
+_NAME_SEP_RE = re.compile(r'[_-]')
+# NUL and control characters except tab, newline and carriage return, deleted in one translate pass
+_CTRL_TABLE = dict.fromkeys([*range(0x00, 0x09), 0x0b, 0x0c, *range(0x0e, 0x20), 0x7f])
+_NL3_RE = re.compile(r'\n{3,}')
+_SPACE_RE = re.compile(r'[ \t]+')
+_TRAIL_SP_RE = re.compile(r' +\n')
+
+_DOT_PAGE_RE = re.compile(r'\.\s*\.+\s*\d+')
+_PAGE_REF_RE = re.compile(r'\.\s+\d+\s*$', re.MULTILINE)
+_CHAPTER_LINE_RE = re.compile(r'^\d+\.\s+[A-Z].*?\d+\s*$', re.MULTILINE)
+_NUMBERED_ITEM_RE = re.compile(r'(?:Chapter|Part|Section)\s+\d+', re.IGNORECASE)
+_LINE_PAGE_RE = re.compile(r'.*\d+\s*$', re.MULTILINE)
+_DOTTED_CHAPTER_RE = re.compile(r'^\d+\.\s+[A-Z].*?\.\s*\.+\s*\d+', re.MULTILINE)
+_CHAPTER_NUM_RE = re.compile(r'Chapter\s+\d+', re.IGNORECASE)
+
+# Tried in priority order; each pattern needs its literal in the text, so a substring
+# check skips the regex on the many pages that cannot match
+SECTION_PATTERNS = [(literal, re.compile(pattern), section_type) for literal, pattern, section_type in [
+    ('CHAPTER', r'(?:^|\n)\s*CHAPTER\s+(\d+)[:\.\s]*([^\n]*)', 'chapter'),
+    ('Chapter', r'(?:^|\n)\s*Chapter\s+(\d+)[:\.\s]*([^\n]*)', 'chapter'),
+    ('.', r'(?:^|\n)\s*(\d+)\.\s+([A-Z][^\n]{5,50})\s*\n', 'chapter'),
+    ('PART', r'(?:^|\n)\s*PART\s+([IVXLCDM]+|\d+)[:\.\s]*([^\n]*)', 'part'),
+    ('Part', r'(?:^|\n)\s*Part\s+([IVXLCDM]+|\d+)[:\.\s]*([^\n]*)', 'part'),
+    ('Appendix', r'(?:^|\n)\s*Appendix\s+([A-Z]|\d+)[:\.\s]*([^\n]*)', 'appendix'),
+]]
+
+
+def get_text_hash(text: str) -> bytes:
+    # Only used as a dedup key: a raw 16-byte BLAKE2b digest is faster than MD5 and half the size of hex
+    normalized = _WS_RE.sub(' ', text.strip().lower())
+    return hashlib.blake2b(normalized.encode(), digest_size=16).digest()
 
 
 def clean_text(text: str) -> str:
-    text = re.sub(r'\x00', '', text)
-    text = re.sub(r'[\x01-\x08\x0b\x0c\x0e-\x1f\x7f]', '', text)
-    text = re.sub(r'\n{3,}', '\n\n', text)
-    text = re.sub(r'[ \t]+', ' ', text)
-    text = re.sub(r' +\n', '\n', text)
+    text = text.translate(_CTRL_TABLE)
+    text = _NL3_RE.sub('\n\n', text)
+    text = _SPACE_RE.sub(' ', text)
+    text = _TRAIL_SP_RE.sub('\n', text)
     return text.strip()
 
 
+def _count_exceeds(pattern: re.Pattern, text: str, limit: int) -> bool:
+    # Stops scanning as soon as the count passes the limit instead of collecting every match
+    for count, _ in enumerate(pattern.finditer(text), 1):
+        if count > limit:
+            return True
+    return False
+
+
 def is_toc_page(text: str) -> bool:
     text_start = text[:500].lower()
     
     if 'table of contents' in text_start or 'contents' in text_start[:100]:
-        dot_pattern = r'\.\s*\.+\s*\d+'
-        if len(re.findall(dot_pattern, text)) > 2:
+        if _count_exceeds(_DOT_PAGE_RE, text, 2):
             return True
         
-        page_ref_pattern = r'\.\s+\d+\s*$'
-        if len(re.findall(page_ref_pattern, text, re.MULTILINE)) > 3:
+        if _count_exceeds(_PAGE_REF_RE, text, 3):
             return True
     
-    chapter_lines = re.findall(r'^\d+\.\s+[A-Z].*?\d+\s*$', text, re.MULTILINE)
-    if len(chapter_lines) > 5:
+    if _count_exceeds(_CHAPTER_LINE_RE, text, 5):
         return True
     
-    numbered_items = re.findall(r'(?:Chapter|Part|Section)\s+\d+', text, re.IGNORECASE)
-    if len(numbered_items) > 3:
-        lines_with_pages = re.findall(r'.*\d+\s*$', text, re.MULTILINE)
-        if len(lines_with_pages) > 5:
-            return True
+    if _count_exceeds(_NUMBERED_ITEM_RE, text, 3) and _count_exceeds(_LINE_PAGE_RE, text, 5):
+        return True
     
     return False
 
 
-def extract_toc_content(pages: list[dict], book_title: str) -> str:
-    toc_pages = []
-    
-    for page in pages:
-        if is_toc_page(page["text"]):
-            toc_pages.append((page.get("page", 0), page["text"]))
+def extract_toc_content(pages: list[dict], book_title: str, toc_flags: list[bool] = None) -> str:
+    if toc_flags is None:
+        toc_flags = [is_toc_page(page["text"]) for page in pages]
+    toc_pages = [(page.get("page", 0), page["text"]) for page, is_toc in zip(pages, toc_flags) if is_toc]
     
     if not toc_pages:
         for page in pages[:20]:
             text = page["text"]
-            if re.search(r'^\d+\.\s+[A-Z].*?\.\s*\.+\s*\d+', text, re.MULTILINE):
+            if _DOTTED_CHAPTER_RE.search(text):
                 toc_pages.append((page.get("page", 0), text))
-            elif len(re.findall(r'Chapter\s+\d+', text, re.IGNORECASE)) > 2:
+            elif len(_CHAPTER_NUM_RE.findall(text)) > 2:
                 toc_pages.append((page.get("page", 0), text))
     
     if toc_pages:
@@ -81,17 +118,11 @@ def extract_toc_content(pages: list[dict], book_title: str) -> str:
 
 
 def detect_section_info(text: str, page_num: int) -> dict:
-    patterns = [
-        (r'(?:^|\n)\s*CHAPTER\s+(\d+)[:\.\s]*([^\n]*)', 'chapter'),
-        (r'(?:^|\n)\s*Chapter\s+(\d+)[:\.\s]*([^\n]*)', 'chapter'),
-        (r'(?:^|\n)\s*(\d+)\.\s+([A-Z][^\n]{5,50})\s*\n', 'chapter'),
-        (r'(?:^|\n)\s*PART\s+([IVXLCDM]+|\d+)[:\.\s]*([^\n]*)', 'part'),
-        (r'(?:^|\n)\s*Part\s+([IVXLCDM]+|\d+)[:\.\s]*([^\n]*)', 'part'),
-        (r'(?:^|\n)\s*Appendix\s+([A-Z]|\d+)[:\.\s]*([^\n]*)', 'appendix'),
-    ]
-    
-    for pattern, section_type in patterns:
-        match = re.search(pattern, text[:500])
+    head = text[:500]
+    for literal, pattern, section_type in SECTION_PATTERNS:
+        if literal not in head:
+            continue
+        match = pattern.search(head)
         if match:
             num = match.group(1)
             title = match.group(2).strip() if match.group(2) else ""
@@ -112,8 +143,8 @@ def get_book_metadata(filename: str) -> dict:
         return BOOK_METADATA[filename].copy()
     
     name = Path(filename).stem
-    name = re.sub(r'[_-]', ' ', name)
-    name = re.sub(r'\s+', ' ', name).strip()
+    name = _NAME_SEP_RE.sub(' ', name)
+    name = _WS_RE.sub(' ', name).strip()
     return {
         "title": name,
         "author": "Unknown",
@@ -121,10 +152,21 @@ def get_book_metadata(filename: str) -> dict:
     }
 
 
-def extract_pdf_text(file_path: Path) -> list[dict]:
+def open_pdf(file_path: Path):
+    # Returns the page objects and a function extracting one page's text
+    if PDF_BACKEND == "pymupdf":
+        if pymupdf is not None:
+            doc = pymupdf.open(file_path)
+            return list(doc), lambda page: page.get_text("text")
+        print("  ⚠️  PyMuPDF not installed, falling back to pypdf")
     reader = PdfReader(file_path)
+    return reader.pages, lambda page: page.extract_text()
+
+
+def extract_pdf_text(file_path: Path) -> list[dict]:
+    pdf_pages, page_text_of = open_pdf(file_path)
     pages = []
-    total_pages = len(reader.pages)
+    total_pages = len(pdf_pages)
     current_section = {}
     book_meta = get_book_metadata(file_path.name)
     
@@ -132,9 +174,9 @@ def extract_pdf_text(file_path: Path) -> list[dict]:
     print(f"  Processing {total_pages} pages...")
     
     raw_pages = []
-    for i, page in enumerate(tqdm(reader.pages, desc=f"  Extracting", leave=False), 1):
+    for i, page in enumerate(tqdm(pdf_pages, desc=f"  Extracting", leave=False), 1):
         try:
-            page_text = page.extract_text()
+            page_text = page_text_of(page)
         except Exception as e:
             continue
             
@@ -147,7 +189,9 @@ def extract_pdf_text(file_path: Path) -> list[dict]:
         
         raw_pages.append({"text": page_text, "page": i, "total_pages": total_pages})
     
-    toc_content = extract_toc_content(raw_pages, book_meta["title"])
+    # Classified once here; both the TOC extraction and the content loop use the flags
+    toc_flags = [is_toc_page(page["text"]) for page in raw_pages]
+    toc_content = extract_toc_content(raw_pages, book_meta["title"], toc_flags)
     if toc_content:
         print(f"  📑 Found Table of Contents")
         pages.append({
@@ -163,13 +207,12 @@ def extract_pdf_text(file_path: Path) -> list[dict]:
     else:
         print(f"  ⚠️  No Table of Contents found")
     
-    for page_data in raw_pages:
+    for page_data, is_toc in zip(raw_pages, toc_flags):
+        if is_toc:
+            continue
         page_text = page_data["text"]
         i = page_data["page"]
         
-        if is_toc_page(page_text):
-            continue
-        
         section_info = detect_section_info(page_text, i)
         if section_info:
             current_section = section_info
@@ -232,12 +275,13 @@ def extract_epub_text(file_path: Path) -> list[dict]:
     
     for item in tqdm(items, desc=f"  Sections", leave=False):
         try:
-            soup = BeautifulSoup(item.get_content(), "lxml")
+            tree = html.document_fromstring(item.get_content())
             
-            for tag in soup(['script', 'style', 'nav', 'header', 'footer']):
-                tag.decompose()
+            # drop_tree keeps each removed tag's tail text, like decompose did
+            for tag in list(tree.iter('script', 'style', 'nav', 'header', 'footer')):
+                tag.drop_tree()
             
-            text = soup.get_text(separator="\n")
+            text = "\n".join(tree.xpath("//text()"))
             text = clean_text(text)
             
             if not text or len(text) < 100:
@@ -245,10 +289,10 @@ def extract_epub_text(file_path: Path) -> list[dict]:
             
             chapter_num += 1
             
-            title_tag = soup.find(["h1", "h2", "h3"])
+            title_tag = next(tree.iter("h1", "h2", "h3"), None)
             chapter_title = ""
-            if title_tag:
-                chapter_title = clean_text(title_tag.get_text())[:100]
+            if title_tag is not None:
+                chapter_title = clean_text(title_tag.text_content())[:100]
             
             if not chapter_title:
                 section_info = detect_section_info(text, chapter_num)
@@ -300,6 +344,14 @@ def extract_text_with_metadata(file_path: Path) -> list[dict]:
     return []
 
 
+def extract_file_buffered(file_path: Path) -> tuple[str, list[dict]]:
+    # Worker output is captured so parallel files don't interleave their progress lines
+    buffer = io.StringIO()
+    with redirect_stdout(buffer):
+        sections = extract_text_with_metadata(file_path)
+    return buffer.getvalue(), sections
+
+
 def get_documents():
     documents = []
     files = sorted([f for f in DATA_DIR.iterdir() if f.suffix.lower() in ALLOWED_EXTENSIONS])
@@ -308,18 +360,46 @@ def get_documents():
     print(f"Found {len(files)} files to process")
     print(f"{'='*60}\n")
     
-    for file_path in files:
-        print(f"\n📂 {file_path.name}")
-        sections = extract_text_with_metadata(file_path)
-        total_chars = sum(len(s["text"]) for s in sections)
-        print(f"  Total: {total_chars:,} characters")
-        documents.extend(sections)
+    extracted = []
+    workers = max(1, min(INGEST_WORKERS, len(files)))
+    if workers == 1:
+        for file_path in files:
+            print(f"\n📂 {file_path.name}")
+            sections = extract_text_with_metadata(file_path)
+            total_chars = sum(len(s["text"]) for s in sections)
+            print(f"  Total: {total_chars:,} characters")
+            extracted.append(sections)
+    else:
+        # Files share no state, so each one is parsed in its own process; map keeps file order
+        # and each file's output is printed under its header as its result comes back
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for file_path, (output, sections) in zip(files, executor.map(extract_file_buffered, files)):
+                print(f"\n📂 {file_path.name}")
+                print(output, end="")
+                total_chars = sum(len(s["text"]) for s in sections)
+                print(f"  Total: {total_chars:,} characters")
+                extracted.append(sections)
+    
+    # Identical sections (shared front matter, repeated pages) are dropped before splitting
+    seen_hashes = set()
+    duplicates = 0
+    for sections in extracted:
+        for section in sections:
+            section_hash = get_text_hash(section["text"])
+            if section_hash in seen_hashes:
+                duplicates += 1
+                continue
+            seen_hashes.add(section_hash)
+            documents.append(section)
+    
+    if duplicates > 0:
+        print(f"\n  Removed {duplicates} duplicate sections")
     
     return documents
 
 
 def deduplicate_chunks(chunks: list[str], metadatas: list[dict]) -> tuple[list[str], list[dict]]:
-    seen_hashes = {}
+    seen_hashes = set()
     unique_chunks = []
     unique_meta = []
     duplicates = 0
@@ -331,7 +411,7 @@ def deduplicate_chunks(chunks: list[str], metadatas: list[dict]) -> tuple[list[s
             duplicates += 1
             continue
         
-        seen_hashes[chunk_hash] = True
+        seen_hashes.add(chunk_hash)
         unique_chunks.append(chunk)
         unique_meta.append(meta)
     
@@ -341,6 +421,10 @@ def deduplicate_chunks(chunks: list[str], metadatas: list[dict]) -> tuple[list[s
     return unique_chunks, unique_meta
 
 
+SECTION_METADATA_KEYS = ("page", "total_pages", "chapter", "chapter_title",
+                         "section_type", "section_num", "section_title")
+
+
 def chunk_documents(documents):
     splitter = RecursiveCharacterTextSplitter(
         chunk_size=CHUNK_SIZE,
@@ -378,34 +462,24 @@ def chunk_documents(documents):
             else:
                 doc_chunks = splitter.split_text(doc["text"])
             
+            # Everything but chunk_index is shared by all chunks of a section
+            base_metadata = {
+                "book_title": doc.get("book_title", "Unknown"),
+                "author": doc.get("author", "Unknown"),
+                "source_file": doc.get("source_file", ""),
+                "total_chunks_in_section": len(doc_chunks),
+                "content_type": content_type,
+            }
+            for key in SECTION_METADATA_KEYS:
+                if key in doc:
+                    base_metadata[key] = doc[key]
+            
             for i, chunk in enumerate(doc_chunks):
                 chunk = chunk.strip()
                 if len(chunk) < 50:
                     continue
                 
-                metadata = {
-                    "book_title": doc.get("book_title", "Unknown"),
-                    "author": doc.get("author", "Unknown"),
-                    "source_file": doc.get("source_file", ""),
-                    "chunk_index": i,
-                    "total_chunks_in_section": len(doc_chunks),
-                    "content_type": content_type,
-                }
-                
-                if "page" in doc:
-                    metadata["page"] = doc["page"]
-                if "total_pages" in doc:
-                    metadata["total_pages"] = doc["total_pages"]
-                if "chapter" in doc:
-                    metadata["chapter"] = doc["chapter"]
-                if "chapter_title" in doc:
-                    metadata["chapter_title"] = doc["chapter_title"]
-                if "section_type" in doc:
-                    metadata["section_type"] = doc["section_type"]
-                if "section_num" in doc:
-                    metadata["section_num"] = doc["section_num"]
-                if "section_title" in doc:
-                    metadata["section_title"] = doc["section_title"]
+                metadata = {**base_metadata, "chunk_index": i}
                 
                 chunks.append(chunk)
                 metadatas.append(metadata)
@@ -427,31 +501,42 @@ def create_vectorstore(chunks, metadatas):
     print(f"Creating embeddings for {len(chunks)} chunks...")
     print(f"{'='*60}")
     
+    # Any ops left in fp32 may use TF32 tensor cores
+    torch.set_float32_matmul_precision('high')
+    # fp16 halves memory traffic and runs on tensor cores; cosine ranking does not need fp32 vectors
     embeddings = HuggingFaceEmbeddings(
         model_name=EMBEDDING_MODEL,
-        model_kwargs={'device': 'cuda'},
-        encode_kwargs={'normalize_embeddings': True},
+        model_kwargs={'device': 'cuda', 'model_kwargs': {'torch_dtype': torch.float16}},
+        encode_kwargs={'normalize_embeddings': True, 'batch_size': EMBED_BATCH_SIZE},
+    )
+    # Chunks unchanged since a previous run load their vectors from disk instead of
+    # being re-embedded; the cache lives outside DB_DIR, which is wiped above
+    EMBEDDING_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    embeddings = CacheBackedEmbeddings.from_bytes_store(
+        embeddings, LocalFileStore(str(EMBEDDING_CACHE_DIR)), namespace=EMBEDDING_MODEL,
+        key_encoder="blake2b",
     )
     
-    batch_size = 500
-    vectorstore = None
+    client = chromadb.PersistentClient(path=str(DB_DIR))
+    collection = client.create_collection(
+        name=CHROMA_COLLECTION,
+        # Embeddings are normalized, so inner product ranks like cosine without the norms
+        metadata={"hnsw:space": "ip"},
+    )
     
+    # Vectors are computed here and written straight to the collection, skipping
+    # the LangChain wrapper's per-batch re-embedding and metadata handling
+    batch_size = 500
     for i in tqdm(range(0, len(chunks), batch_size), desc="Embedding"):
         batch_chunks = chunks[i:i+batch_size]
-        batch_meta = metadatas[i:i+batch_size]
-        
-        if vectorstore is None:
-            vectorstore = Chroma.from_texts(
-                texts=batch_chunks,
-                embedding=embeddings,
-                metadatas=batch_meta,
-                collection_name=CHROMA_COLLECTION,
-                persist_directory=str(DB_DIR),
-            )
-        else:
-            vectorstore.add_texts(texts=batch_chunks, metadatas=batch_meta)
+        collection.add(
+            ids=[f"{j:08x}" for j in range(i, i + len(batch_chunks))],
+            documents=batch_chunks,
+            embeddings=embeddings.embed_documents(batch_chunks),
+            metadatas=metadatas[i:i+batch_size],
+        )
     
-    return vectorstore
+    return collection
 
 
 def main():
@@ -490,12 +575,16 @@ def main():
     print(f"Vector store saved to: {DB_DIR}")
     print(f"Total chunks indexed: {len(chunks)}")
     
-    books = set(m.get("book_title", "Unknown") for m in metadatas)
+    chunk_counts = Counter()
+    toc_counts = Counter()
+    for m in metadatas:
+        book = m.get("book_title", "Unknown")
+        chunk_counts[book] += 1
+        if m.get("content_type") == "table_of_contents":
+            toc_counts[book] += 1
     print(f"\nBooks indexed:")
-    for book in sorted(books):
-        count = sum(1 for m in metadatas if m.get("book_title") == book)
-        toc = sum(1 for m in metadatas if m.get("book_title") == book and m.get("content_type") == "table_of_contents")
-        print(f"  📖 {book}: {count} chunks ({toc} TOC)")
+    for book in sorted(chunk_counts):
+        print(f"  📖 {book}: {chunk_counts[book]} chunks ({toc_counts[book]} TOC)")
 
 
 if __name__ == "__main__":
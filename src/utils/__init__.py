@@ -1,5 +1,5 @@
 # Utils module
 from .security import RateLimiter, sanitize_input, escape_output
-from .models import get_model, get_vectorstore, get_reranker
+from .models import get_model, get_draft_model, get_vectorstore, get_reranker
 
-__all__ = ['RateLimiter', 'sanitize_input', 'escape_output', 'get_model', 'get_vectorstore', 'get_reranker']
+__all__ = ['RateLimiter', 'sanitize_input', 'escape_output', 'get_model', 'get_draft_model', 'get_vectorstore', 'get_reranker']
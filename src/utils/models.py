@@ -1,50 +1,90 @@
 import torch
+import warnings
+from functools import lru_cache
 from transformers import AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig
+from transformers.utils import is_flash_attn_2_available
 from langchain_huggingface import HuggingFaceEmbeddings
 from langchain_chroma import Chroma
 from flashrank import Ranker
 
-from config import DB_DIR, MODEL_NAME, EMBEDDING_MODEL, CHROMA_COLLECTION
+from config import (
+    DB_DIR, MODEL_NAME, DRAFT_MODEL_NAME, EMBEDDING_MODEL, CHROMA_COLLECTION,
+    QUANTIZATION, COMPILE_MODEL, RERANK_MAX_LENGTH,
+)
 
-_cache = {}
+def _compute_dtype():
+    if torch.cuda.is_available() and torch.cuda.is_bf16_supported():
+        return torch.bfloat16
+    return torch.float16
 
 
-def get_model():
-    if "model" not in _cache:
-        config = BitsAndBytesConfig(
+def _quantization_config():
+    if QUANTIZATION == "8bit":
+        return BitsAndBytesConfig(load_in_8bit=True)
+    if QUANTIZATION == "4bit":
+        return BitsAndBytesConfig(
             load_in_4bit=True,
-            bnb_4bit_compute_dtype=torch.float16,
+            bnb_4bit_compute_dtype=_compute_dtype(),
             bnb_4bit_quant_type="nf4",
+            bnb_4bit_use_double_quant=True,
         )
-        _cache["tokenizer"] = AutoTokenizer.from_pretrained(MODEL_NAME)
-        _cache["model"] = AutoModelForCausalLM.from_pretrained(
-            MODEL_NAME,
-            quantization_config=config,
-            device_map="auto",
-            trust_remote_code=True,
-        )
-    return _cache["model"], _cache["tokenizer"]
+    return None
+
+
+@lru_cache(maxsize=1)
+def get_model():
+    tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME)
+    model = AutoModelForCausalLM.from_pretrained(
+        MODEL_NAME,
+        quantization_config=_quantization_config(),
+        torch_dtype=_compute_dtype(),
+        attn_implementation="flash_attention_2" if is_flash_attn_2_available() else "sdpa",
+        device_map="auto",
+        trust_remote_code=True,
+    )
+    if COMPILE_MODEL:
+        # Fixed cache shapes let the compiled forward replay CUDA graphs on every decode step;
+        # graph breaks are allowed because bitsandbytes kernels are not always traceable
+        model.generation_config.cache_implementation = "static"
+        model.forward = torch.compile(model.forward, mode="reduce-overhead", fullgraph=False)
+    return model, tokenizer
 
 
+@lru_cache(maxsize=1)
+def get_draft_model():
+    # Small model sharing the main tokenizer, used for assisted (speculative) decoding
+    if not DRAFT_MODEL_NAME:
+        return None
+    if COMPILE_MODEL:
+        # transformers rejects assisted generation with the static cache a compiled model uses
+        warnings.warn("DRAFT_MODEL_NAME is ignored because COMPILE_MODEL is enabled")
+        return None
+    return AutoModelForCausalLM.from_pretrained(
+        DRAFT_MODEL_NAME,
+        torch_dtype=_compute_dtype(),
+        device_map="auto",
+        trust_remote_code=True,
+    )
+
+
+@lru_cache(maxsize=1)
 def get_vectorstore():
-    if "vectorstore" not in _cache:
-        embeddings = HuggingFaceEmbeddings(
-            model_name=EMBEDDING_MODEL,
-            model_kwargs={'device': 'cuda'},
-            encode_kwargs={'normalize_embeddings': True},
-        )
-        _cache["vectorstore"] = Chroma(
-            collection_name=CHROMA_COLLECTION,
-            persist_directory=str(DB_DIR),
-            embedding_function=embeddings,
-        )
-    return _cache["vectorstore"]
+    embeddings = HuggingFaceEmbeddings(
+        model_name=EMBEDDING_MODEL,
+        model_kwargs={'device': 'cuda'},
+        encode_kwargs={'normalize_embeddings': True},
+    )
+    return Chroma(
+        collection_name=CHROMA_COLLECTION,
+        persist_directory=str(DB_DIR),
+        embedding_function=embeddings,
+    )
 
 
+@lru_cache(maxsize=1)
 def get_reranker():
-    if "reranker" not in _cache:
-        _cache["reranker"] = Ranker(
-            model_name="ms-marco-MultiBERT-L-12",
-            cache_dir="./cache"
-        )
-    return _cache["reranker"]
+    return Ranker(
+        model_name="ms-marco-MultiBERT-L-12",
+        cache_dir="./cache",
+        max_length=RERANK_MAX_LENGTH,
+    )
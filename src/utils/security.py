@@ -1,10 +1,15 @@
 import re
-from datetime import datetime, timedelta
+import time
+import threading
+from functools import lru_cache
+from collections import deque
 from dataclasses import dataclass, field
 
 MAX_QUERY_LENGTH = 1000
 MAX_QUERIES_PER_MINUTE = 10
 MAX_QUERIES_PER_HOUR = 100
+MINUTE = 60.0
+HOUR = 3600.0
 
 BLOCKED_PATTERNS = [
     r'<script', r'javascript:', r'on\w+\s*=',
@@ -16,45 +21,91 @@ BLOCKED_PATTERNS = [
 ]
 
 
+def _literal(pattern: str) -> str | None:
+    # The plain text a pattern matches, or None when it uses real regex syntax
+    if re.search(r'[.^$*+?{}\[\]|()\\]', re.sub(r'\\\W', '', pattern)):
+        return None
+    return re.sub(r'\\(\W)', r'\1', pattern).lower()
+
+
+def _alternation(patterns: list[str]) -> re.Pattern:
+    # One alternation: a single scan of the query instead of one search per pattern.
+    # An empty list must match nothing; joining it would give "", which matches everything
+    if not patterns:
+        return re.compile(r'(?!)')
+    return re.compile("|".join(f"(?:{p})" for p in patterns), re.IGNORECASE)
+
+
+_BLOCKED_RE = _alternation(BLOCKED_PATTERNS)
+# Most entries are plain keywords: substring checks on the lowercased query cover them,
+# and only the rest need the regex engine
+_BLOCKED_LITERALS = tuple(lit for lit in map(_literal, BLOCKED_PATTERNS) if lit is not None)
+_BLOCKED_REGEX_RE = _alternation([p for p in BLOCKED_PATTERNS if _literal(p) is None])
+
+# Anything outside word characters, whitespace and basic punctuation is dropped, a run at a time
+_STRIP_RE = re.compile(r'[^\w\s\.,\?!;:\'\"-]+')
+# The same filter for ASCII text as a translate table, built from the regex so the two cannot drift
+_ASCII_STRIP_TABLE = dict.fromkeys(c for c in range(128) if _STRIP_RE.match(chr(c)))
+
+
+def _is_blocked(text: str) -> bool:
+    # str.lower() and re.IGNORECASE fold some non-ASCII letters differently,
+    # so only ASCII input takes the substring path
+    if not text.isascii():
+        return _BLOCKED_RE.search(text) is not None
+    lowered = text.lower()
+    if any(literal in lowered for literal in _BLOCKED_LITERALS):
+        return True
+    return _BLOCKED_REGEX_RE.search(text) is not None
+
+
 @dataclass
 class RateLimiter:
-    minute_queries: list = field(default_factory=list)
-    hour_queries: list = field(default_factory=list)
+    # time.monotonic() stamps of the most recent accepted queries; the hour window keeps
+    # the most, and the minute window is its newest MAX_QUERIES_PER_MINUTE entries
+    queries: deque = field(default_factory=lambda: deque(maxlen=max(MAX_QUERIES_PER_HOUR, MAX_QUERIES_PER_MINUTE)))
+    # Check-then-append must be atomic, or concurrent reruns could both pass a full window
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False, compare=False)
     
     def check(self) -> tuple[bool, str]:
-        now = datetime.now()
-        self.minute_queries = [t for t in self.minute_queries if now - t < timedelta(minutes=1)]
-        self.hour_queries = [t for t in self.hour_queries if now - t < timedelta(hours=1)]
-        
-        if len(self.minute_queries) >= MAX_QUERIES_PER_MINUTE:
-            return False, "Rate limit: wait a minute."
-        if len(self.hour_queries) >= MAX_QUERIES_PER_HOUR:
-            return False, "Hourly limit reached."
-        
-        self.minute_queries.append(now)
-        self.hour_queries.append(now)
-        return True, ""
+        with self._lock:
+            now = time.monotonic()
+            q = self.queries
+            
+            # A window is exhausted when its limit-th most recent query is still inside it
+            if len(q) >= MAX_QUERIES_PER_MINUTE and now - q[-MAX_QUERIES_PER_MINUTE] < MINUTE:
+                return False, "Rate limit: wait a minute."
+            if len(q) >= MAX_QUERIES_PER_HOUR and now - q[-MAX_QUERIES_PER_HOUR] < HOUR:
+                return False, "Hourly limit reached."
+            
+            q.append(now)
+            return True, ""
 
 
 def sanitize_input(text: str) -> tuple[str, bool]:
     if not text or not isinstance(text, str):
         return "", False
+    # Truncate before the cache so its keys stay bounded by MAX_QUERY_LENGTH
+    return _sanitize_cached(text.strip()[:MAX_QUERY_LENGTH])
+
+
+# Resubmitted and retried queries skip the whole pipeline; results are immutable tuples
+@lru_cache(maxsize=1024)
+def _sanitize_cached(text: str) -> tuple[str, bool]:
+    if _is_blocked(text):
+        return "", False
     
-    text = text.strip()
-    if len(text) > MAX_QUERY_LENGTH:
-        text = text[:MAX_QUERY_LENGTH]
-    
-    for pattern in BLOCKED_PATTERNS:
-        if re.search(pattern, text, re.IGNORECASE):
-            return "", False
-    
-    text = re.sub(r'[^\w\s\.,\?!;:\'\"-]', '', text)
+    text = text.translate(_ASCII_STRIP_TABLE) if text.isascii() else _STRIP_RE.sub('', text)
     return text.strip(), bool(text)
 
 
 def escape_output(text: str) -> str:
     if not text:
         return ""
+    # Most answers contain none of these; membership tests are memchr scans, far cheaper
+    # than four replace passes that each copy the string
+    if not ("&" in text or "<" in text or ">" in text or '"' in text):
+        return text
     return (text
             .replace("&", "&amp;")
             .replace("<", "&lt;")